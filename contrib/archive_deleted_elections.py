@@ -0,0 +1,148 @@
+#!/usr/bin/env python3
+
+import argparse
+import os
+import sys
+import json
+import time
+import shutil
+import tarfile
+import concurrent.futures
+
+# Example :
+#   ./archive_deleted_elections.py --jobs 4 /var/lib/belenios/spool /srv/belenios-deleted
+
+# Unlike move_deleted_elections.sh, each deleted election is packed into
+# a single compressed archive TARGET/$UUID.tar.$COMPRESSION, and a line
+# with its deleted.json summary is appended to TARGET/index.jsonl.
+#
+# This can be run while the server is live:
+#  - elections with a file modified less than --min-age minutes ago are
+#    left alone;
+#  - each election is first renamed (atomically) to a staging directory
+#    SPOOL/.archiving-$UUID, so that it disappears from the spool at once;
+#  - the archive is written to a temporary file and renamed when complete;
+#  - the staging directory is removed only after the archive and its
+#    index line have been written.
+# Staging directories left by an interrupted run are resumed: the
+# staging directory is the source of truth, so its archive is rebuilt,
+# and its index line is only written if missing.
+
+STAGING_PREFIX = ".archiving-"
+INDEX_FILE = "index.jsonl"
+
+def archive_name(target, uuid, compression):
+    return os.path.join(target, "{}.tar.{}".format(uuid, compression))
+
+# Most recent modification time of a directory and its contents.
+def last_modified(path):
+    result = os.stat(path).st_mtime
+    for root, dirs, files in os.walk(path):
+        for f in dirs + files:
+            try:
+                result = max(result, os.lstat(os.path.join(root, f)).st_mtime)
+            except FileNotFoundError:
+                pass
+    return result
+
+# Deleted elections that are ready to be archived, as (uuid, path) pairs.
+def find_candidates(spool, min_age):
+    now = time.time()
+    result = []
+    for f in os.listdir(spool):
+        path = os.path.join(spool, f)
+        if f.startswith(STAGING_PREFIX):
+            result.append((f[len(STAGING_PREFIX):], path))
+            continue
+        if not os.path.isfile(os.path.join(path, "deleted.json")):
+            continue
+        if now - last_modified(path) < min_age * 60:
+            print("Election {} was modified recently, skipping".format(f), file=sys.stderr)
+            continue
+        staging = os.path.join(spool, STAGING_PREFIX + f)
+        os.rename(path, staging)
+        result.append((f, staging))
+    return result
+
+# uuids among the given ones that already have an index line
+def indexed_uuids(target, uuids):
+    result = set()
+    try:
+        with open(os.path.join(target, INDEX_FILE), "r") as index:
+            for line in index:
+                try:
+                    uuid = json.loads(line)["uuid"]
+                except (ValueError, KeyError):
+                    # partially written last line
+                    continue
+                if uuid in uuids:
+                    result.add(uuid)
+    except FileNotFoundError:
+        pass
+    return result
+
+# Pack one staged election. Runs in a worker process; returns the index
+# entry, or raises. An archive left by an interrupted run is replaced.
+def pack_election(uuid, staging, target, compression):
+    dest = archive_name(target, uuid, compression)
+    with open(os.path.join(staging, "deleted.json"), "r") as f:
+        summary = json.load(f)
+    tmp = dest + ".tmp"
+    with open(tmp, "wb") as f:
+        with tarfile.open(fileobj=f, mode="w:" + compression) as tar:
+            tar.add(staging, arcname=uuid)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, dest)
+    return {"uuid": uuid, "archive": os.path.basename(dest), "deleted": summary}
+
+def main():
+    parser = argparse.ArgumentParser(description="pack deleted elections out of the spool into compressed archives")
+    parser.add_argument("spool_directory",
+            help="Spool directory where the elections are stored")
+    parser.add_argument("target_directory",
+            help="Directory where the archives and their index are written")
+    parser.add_argument("--jobs", type=int, default=os.cpu_count(),
+            help="number of elections packed in parallel")
+    parser.add_argument("--min-age", type=int, default=60, metavar="MINUTES",
+            help="skip elections modified less than this many minutes ago (default: 60)")
+    parser.add_argument("--compression", choices=["gz", "bz2", "xz"], default="xz",
+            help="compression of the archives (default: xz)")
+    args = parser.parse_args()
+
+    if not os.path.isdir(args.spool_directory) or not os.path.isdir(args.target_directory):
+        parser.print_usage(sys.stderr)
+        sys.exit(1)
+
+    candidates = find_candidates(args.spool_directory, args.min_age)
+    # interrupted runs may have written the index line already
+    indexed = indexed_uuids(args.target_directory,
+                            set(uuid for uuid, staging in candidates))
+    failed = False
+    with open(os.path.join(args.target_directory, INDEX_FILE), "a") as index:
+        with concurrent.futures.ProcessPoolExecutor(max_workers=args.jobs) as executor:
+            futures = {}
+            for uuid, staging in candidates:
+                future = executor.submit(pack_election, uuid, staging,
+                                         args.target_directory, args.compression)
+                futures[future] = (uuid, staging)
+            for future in concurrent.futures.as_completed(futures):
+                uuid, staging = futures[future]
+                try:
+                    entry = future.result()
+                except Exception as e:
+                    print("Failed to archive election {}: {}".format(uuid, e), file=sys.stderr)
+                    failed = True
+                    continue
+                if uuid not in indexed:
+                    index.write(json.dumps(entry, sort_keys=True) + "\n")
+                    index.flush()
+                    os.fsync(index.fileno())
+                shutil.rmtree(staging)
+                print("Archived election {}".format(uuid))
+
+    if failed:
+        sys.exit(2)
+
+if __name__ == "__main__":
+    main()
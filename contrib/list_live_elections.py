@@ -26,11 +26,15 @@ def is_draft_or_deleted(elec_path):
     if os.path.exists(os.path.join(elec_path, "draft.json")):
         return True
 
-def is_secure(elec_path):
-    meta = os.path.join(elec_path, "metadata.json")
-    assert os.path.exists(meta)
-    with open(meta,"r") as file:
-        data = json.load(file)
+# metadata.json and dates.json are read once per election, and used
+# both for filtering and for the facts printed with --json
+def load_json(elec_path, name):
+    path = os.path.join(elec_path, name)
+    assert os.path.exists(path)
+    with open(path,"r") as file:
+        return json.load(file)
+
+def is_secure(data):
     if 'cred_authority' in data and data['cred_authority'] != 'server':
         return True
     if 'trustees' in data:
@@ -38,7 +42,11 @@ def is_secure(elec_path):
             return True
     return False
 
-def is_test(elec_path, uuid):
+def count_voters(elec_path):
+    voters = os.path.join(elec_path, "voters.txt")
+    return sum(1 for line in open(voters, "r"))
+
+def is_test(elec_path, uuid, num_voters):
     bel = uuid + ".bel"
     elec = os.path.join(elec_path, bel)
     if not os.path.exists(elec):
@@ -48,8 +56,6 @@ def is_test(elec_path, uuid):
         data = json.load(file.extractfile(file.getmembers()[1]))
     if re.search("test", data['name'], re.IGNORECASE) != None:
         return True
-    voters = os.path.join(elec_path, "voters.txt")
-    num_voters = sum(1 for line in open(voters, "r"))
     if num_voters < MIN_VOTERS:
         return True
     return False
@@ -63,11 +69,7 @@ def parse_date(s):
         d = datetime.datetime.strptime(s, "%Y-%m-%d %H:%M:%S")
     return d
 
-def is_old(elec_path):
-    dates = os.path.join(elec_path, "dates.json")
-    assert os.path.exists(dates)
-    with open(dates,"r") as file:
-        data = json.load(file)
+def is_old(data):
     if 'archive' in data:
         return True
     now = datetime.datetime.now()
@@ -85,26 +87,64 @@ def is_old(elec_path):
             return True
     return False
 
+# Facts about a live election, printed with --json and used for sorting
+def election_facts(elec_path, uuid, num_voters, meta, dates):
+    bel = os.stat(os.path.join(elec_path, uuid + ".bel"))
+    return {
+        "uuid": uuid,
+        "voters": num_voters,
+        "trustees": len(meta.get('trustees', [])),
+        "cred_authority": meta.get('cred_authority'),
+        "finalization": dates.get('finalization'),
+        "tally": dates.get('tally'),
+        "bel_size": bel.st_size,
+        "bel_mtime": int(bel.st_mtime),
+    }
+
+# Sort keys for --sort; elections with the highest value come first.
+SORT_KEYS = {
+    "none": None,
+    "bel_mtime": lambda x: x["bel_mtime"],
+    "bel_size": lambda x: x["bel_size"],
+    "voters": lambda x: x["voters"],
+    "finalization": lambda x: parse_date(x["finalization"]) if x["finalization"] else datetime.datetime.min,
+}
+
 parser = argparse.ArgumentParser(description="list elections that are alive and deserve to be monitored")
 parser.add_argument("spool_directory",
         help="Spool directory where the elections are stored")
 parser.add_argument("--verbose", help="explain why elections are discarded on stderr", action="store_true")
+parser.add_argument("--json", help="print one JSON object with facts about the election per line, instead of its uuid", action="store_true")
+parser.add_argument("--sort", choices=SORT_KEYS.keys(), default="none",
+        help="print elections in decreasing order of this key (default: spool order)")
 args = parser.parse_args()
 verb = args.verbose
 
 uuids = all_uuid(args.spool_directory)
+live = []
 for uuid in uuids:
     elec_path = os.path.join(args.spool_directory, uuid)
     if is_draft_or_deleted(elec_path):
         verb_print("Election {} is deleted or not yet finalized".format(uuid))
         continue
-    if is_test(elec_path, uuid):
+    num_voters = count_voters(elec_path)
+    if is_test(elec_path, uuid, num_voters):
         verb_print("Election {} is probably a test election".format(uuid))
         continue
-    if not is_secure(elec_path):
+    meta = load_json(elec_path, "metadata.json")
+    if not is_secure(meta):
         verb_print("Election {} is in degraded mode".format(uuid))
         continue
-    if is_old(elec_path):
+    dates = load_json(elec_path, "dates.json")
+    if is_old(dates):
         verb_print("Election {} is old".format(uuid))
         continue
-    print(uuid)
+    live.append(election_facts(elec_path, uuid, num_voters, meta, dates))
+
+if SORT_KEYS[args.sort] is not None:
+    live.sort(key=SORT_KEYS[args.sort], reverse=True)
+for x in live:
+    if args.json:
+        print(json.dumps(x))
+    else:
+        print(x["uuid"])
@@ -12,8 +12,14 @@ import re
 import hashlib
 import base64
 import json
+import io
 import random
 import tarfile
+import shutil
+import fcntl
+import heapq
+import threading
+import queue
 
 # Example :
 #   ./monitor_elections.py --uuid aTGmQNj1SXA5JG --url https://vote.example.org/ --wdir /tmp/wdir --checkhash yes --hashref $HOME/hashref --outputref  $HOME/hashref --sighashref https://vote.example.org/monitoring-reference/reference.json.gpg --keyring $HOME/.gnupg/pubring.gpg
@@ -24,6 +30,17 @@ import tarfile
 # - git
 # - (optional) gpg
 
+# With --blobcache, the members of the downloaded archives are stored
+# once in a content-addressed cache in the wdir (.blobcache/), keyed by
+# their SHA-256, and hard-linked (or reflinked, or copied as a last
+# resort) into the election directories. The git repositories of the
+# elections use a shared bare repository (.shared.git/) as alternates
+# object store, so that identical blobs are stored only once.
+# Never run "git gc --prune" in .shared.git: it has no refs, and all
+# its objects would be considered unreachable. For the same reason,
+# .shared.git is never trimmed: only .blobcache/ is kept within
+# --blobcache-size.
+
 
 # TODO:
 # - add options --belenios-tool-path
@@ -75,11 +92,144 @@ def check_or_create_dir(wdir, uuid):
         subprocess.run(["git", "init", p], capture_output=True)
         open(os.path.join(p, "fresh"), "w").close()
 
+##################################
+## Content-addressed cache of archive members, shared by all elections
+
+BLOBCACHE_DIR = ".blobcache"
+SHARED_GIT_DIR = ".shared.git"
+# from linux/fs.h
+FICLONE = 0x40049409
+
+def blobcache_path(wdir, h):
+    return os.path.join(wdir, BLOBCACHE_DIR, h[:2], h)
+
+# Create the cache and the shared git object store if needed.
+def init_blobcache(wdir):
+    os.makedirs(os.path.join(wdir, BLOBCACHE_DIR), exist_ok=True)
+    g = os.path.join(wdir, SHARED_GIT_DIR)
+    if not os.path.exists(g):
+        logme("init shared git object store in {}".format(g))
+        subprocess.run(["git", "init", "-q", "--bare", g], capture_output=True)
+        # objects of the shared store are not reachable from its own refs
+        subprocess.run(["git", "--git-dir", g, "config", "gc.auto", "0"])
+        subprocess.run(["git", "--git-dir", g, "config", "gc.pruneExpire", "never"])
+
+# Make the git repository of an election borrow objects from the
+# shared store.
+def set_git_alternates(wdir, uuid):
+    shared = os.path.abspath(os.path.join(wdir, SHARED_GIT_DIR, "objects"))
+    info = os.path.join(wdir, uuid, ".git", "objects", "info")
+    alternates = os.path.join(info, "alternates")
+    if os.path.exists(alternates):
+        with open(alternates, "r") as f:
+            if shared in f.read().splitlines():
+                return
+    os.makedirs(info, exist_ok=True)
+    with open(alternates, "a") as f:
+        f.write(shared + "\n")
+
+# Materialise a cached blob at dst, sharing storage when possible.
+def link_or_copy(src, dst, content):
+    try:
+        os.link(src, dst)
+        return
+    except OSError:
+        pass
+    try:
+        with open(src, "rb") as fsrc, open(dst, "wb") as fdst:
+            try:
+                fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+            except OSError:
+                shutil.copyfileobj(fsrc, fdst)
+    except OSError:
+        # the blob may have been evicted concurrently
+        with open(dst, "wb") as f:
+            f.write(content)
+
+# Store the members of an archive in the cache (and in the shared git
+# object store) and materialise them in the election directory.
+# Members that are not plain files with a flat name are extracted
+# as usual.
+def blobcache_extract(wdir, eldir, bel, members):
+    new_blobs = []
+    for m in members:
+        if not m.isfile() or os.path.basename(m.name) != m.name or m.name.startswith("."):
+            bel.extract(m, path=eldir)
+            continue
+        content = bel.extractfile(m).read()
+        h = hashlib.sha256(content).hexdigest()
+        src = blobcache_path(wdir, h)
+        try:
+            # the mtime is used for LRU eviction
+            os.utime(src)
+        except FileNotFoundError:
+            # absent, or evicted meanwhile by another monitor
+            os.makedirs(os.path.dirname(src), exist_ok=True)
+            tmp = "{}.tmp{}".format(src, os.getpid())
+            with open(tmp, "wb") as f:
+                f.write(content)
+            os.replace(tmp, src)
+            new_blobs.append(src)
+        dst = os.path.join(eldir, m.name)
+        if os.path.exists(dst):
+            try:
+                if os.path.samefile(src, dst):
+                    continue
+            except FileNotFoundError:
+                pass
+            os.remove(dst)
+        link_or_copy(src, dst, content)
+    if new_blobs:
+        gitdir = os.path.join(wdir, SHARED_GIT_DIR)
+        hashobj = subprocess.run(["git", "--git-dir", gitdir, "hash-object", "-w", "--stdin-paths"],
+                input="\n".join(new_blobs).encode(), stdout=subprocess.DEVNULL)
+        if hashobj.returncode != 0:
+            Elogme("Failed to store blobs in shared git object store {}".format(gitdir))
+
+# Remove least recently used blobs until the cache fits in budget bytes.
+# Only blobs that are no longer linked from any election directory
+# (st_nlink == 1) use disk space of their own: they are the only ones
+# counted and evicted.
+def blobcache_evict(wdir, budget):
+    entries = []
+    total = 0
+    for root, dirs, files in os.walk(os.path.join(wdir, BLOBCACHE_DIR)):
+        for f in files:
+            path = os.path.join(root, f)
+            try:
+                st = os.stat(path)
+            except FileNotFoundError:
+                continue
+            if st.st_nlink != 1:
+                continue
+            entries.append((st.st_mtime, st.st_size, path))
+            total += st.st_size
+    if total <= budget:
+        return
+    entries.sort()
+    evicted = 0
+    for mtime, size, path in entries:
+        if total <= budget:
+            break
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+        total -= size
+        evicted += 1
+    logme("Evicted {} blobs from the blob cache".format(evicted))
+
 # List of audit files.
 # We put here a fake filename for the hash of the voterlist
 # and for the list of all ballot hashs.
 audit_files=['election.json', 'ballots', 'audit-cache', 'election.bel']
 optional_audit_files=['hash_voterlist','all_ballot_hashs']
+# The raw ballots download is a single JSON blob that is not ordered.
+# It is only committed on cycles where it changed; what is committed
+# every time is a canonical form of the ballots and of their summary,
+# one ballot per line sorted by hash, so that git stores small deltas
+# and "git log -S <hash>" finds when a ballot appeared.
+canonical_ballot_files=['ballots.txt', 'ballot_summary.txt']
 
 def shuffle(l):
     result = [x for x in l]
@@ -122,6 +272,114 @@ def download_audit_data(wdir, url, uuid):
     status = Status(fail, msg.encode())
     return status, data
 
+##################################
+## Incremental pre-check of the event chain of the .bel archive
+
+# The archive is an old-style tar file that only grows. Each member
+# (except the BELENIOS header) is named after the SHA-256 of its
+# contents, and each event refers to its predecessor by hash. We
+# remember where the last verified event is, so that only the appended
+# members have to be read.
+BEL_BLOCK_SIZE = 512
+BEL_HEAD_FILE = "bel_head"
+
+# Yield (offset, name, contents, next_offset) for each member of an
+# archive, starting from the tar header found at the given offset.
+def read_bel_members(f, offset):
+    f.seek(offset)
+    while True:
+        header = f.read(BEL_BLOCK_SIZE)
+        if len(header) == 0 or header == bytes(BEL_BLOCK_SIZE):
+            return
+        if len(header) < BEL_BLOCK_SIZE:
+            raise ValueError("truncated tar header at offset {}".format(offset))
+        name = header[0:100].split(b"\0", 1)[0].decode()
+        size = int(header[124:136].split(b"\0", 1)[0].strip() or b"0", 8)
+        contents = f.read(size)
+        if len(contents) < size:
+            raise ValueError("truncated member {}".format(name))
+        next_offset = offset + BEL_BLOCK_SIZE + (size + BEL_BLOCK_SIZE - 1) // BEL_BLOCK_SIZE * BEL_BLOCK_SIZE
+        yield offset, name, contents, next_offset
+        offset = next_offset
+        f.seek(offset)
+
+def read_bel_head(p):
+    try:
+        with open(os.path.join(p, BEL_HEAD_FILE), "r") as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+
+def write_bel_head(p, head):
+    tmp = os.path.join(p, BEL_HEAD_FILE + ".tmp")
+    with open(tmp, "w") as f:
+        json.dump(head, f)
+    os.replace(tmp, os.path.join(p, BEL_HEAD_FILE))
+
+# Check that archive extends the one verified last time, and that the
+# appended members are correctly hashed and chained. Returns a status,
+# the new head to be saved once verification is over, and whether the
+# archive is known to be a pure append of the last verified one.
+def precheck_bel(p, uuid, archive):
+    old = read_bel_head(p)
+    if old is None:
+        head = {"offset": 0, "event_offset": None, "hash": None, "height": -1}
+    else:
+        head = dict(old)
+    f = io.BytesIO(archive)
+    try:
+        if old is not None:
+            if len(archive) < old["offset"]:
+                msg = "Error: archive of election {} is shorter than the verified one\n".format(uuid)
+                return Status(True, msg.encode()), None, False
+            if old["event_offset"] is not None:
+                try:
+                    _, name, contents, _ = next(read_bel_members(f, old["event_offset"]))
+                except (ValueError, StopIteration):
+                    name, contents = None, b""
+                if name != old["hash"] + ".event.json" or hashlib.sha256(contents).hexdigest() != old["hash"]:
+                    msg = "Error: history of election {} has been rewritten\n".format(uuid)
+                    return Status(True, msg.encode()), None, False
+        for offset, name, contents, next_offset in read_bel_members(f, head["offset"]):
+            head["offset"] = next_offset
+            if offset == 0:
+                if name != "BELENIOS":
+                    raise ValueError("missing BELENIOS header")
+                continue
+            h, _, kind = name.partition(".")
+            if hashlib.sha256(contents).hexdigest() != h:
+                raise ValueError("member {} does not match its hash".format(name))
+            if kind == "event.json":
+                event = json.loads(contents)
+                if event.get("parent") != head["hash"] or event["height"] != head["height"] + 1:
+                    raise ValueError("event {} does not chain to {}".format(h, head["hash"]))
+                head["event_offset"] = offset
+                head["hash"] = h
+                head["height"] = event["height"]
+            elif kind != "data.json":
+                raise ValueError("unexpected member {}".format(name))
+    except (ValueError, KeyError, StopIteration) as e:
+        msg = "Error: event chain check failed for election {}: {}\n".format(uuid, e)
+        return Status(True, msg.encode()), None, False
+    return Status(False, b""), head, old is not None
+
+# One "hash weight" line per ballot
+def canonical_ballots(ballots):
+    lines = ["{} {}\n".format(h, json.dumps(w)) for h, w in sorted(json.loads(ballots).items())]
+    return "".join(lines).encode()
+
+# One JSON object per ballot
+def canonical_ballot_summary(summary):
+    lines = [json.dumps(x, sort_keys=True) + "\n" for x in sorted(json.loads(summary), key=lambda x: x["hash"])]
+    return "".join(lines).encode()
+
+def same_contents(path, contents):
+    try:
+        with open(path, "rb") as f:
+            return f.read() == contents
+    except FileNotFoundError:
+        return False
+
 def get_new_ballots(old_ballotsfile, new_ballotsfile):
     old = set([b64_of_hex(x["hash"]) for x in json.loads(old_ballotsfile)])
     result = b""
@@ -135,7 +393,7 @@ def get_new_ballots(old_ballotsfile, new_ballotsfile):
 # verify-diff.
 # At first, this goes to a 'new' subdirectory, and once verify-diff has
 # been run, this is moved to the main directory of the election.
-def write_and_verify_new_data(wdir, uuid, data):
+def write_and_verify_new_data(wdir, uuid, data, blobcache=False):
     # copy new data in the "new" subdirectory
     p = os.path.join(wdir, uuid)
     pnew = os.path.join(p, 'new')
@@ -144,21 +402,29 @@ def write_and_verify_new_data(wdir, uuid, data):
             with open(os.path.join(pnew, f), "wb") as newf:
                 newf.write(data[f])
 
-    # run belenios-tool verify on it
-    ver = subprocess.run(["belenios-tool", "election", "verify", "--dir={}".format(pnew)],
-            stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
-    if ver.returncode != 0:
-        msg="Error: belenios-tool election verify failed on newly downloaded data from election {}, with output {}\n".format(uuid, ver.stdout).encode()
-        return Status(True, msg)
-    else:
-        logme("Successfully verified new data of {}".format(uuid))
+    # cheap check that the archive is an append of the verified one
+    fresh = os.path.exists(os.path.join(p, "fresh"))
+    precheck, bel_head, appended = precheck_bel(p, uuid, data['election.bel'])
+    if precheck.fail:
+        return precheck
+    logme("Successfully checked event chain of {}".format(uuid))
+
+    # run belenios-tool verify on it, unless verify-diff below will
+    # (it verifies the whole new archive too)
+    if fresh or not appended:
+        ver = subprocess.run(["belenios-tool", "election", "verify", "--dir={}".format(pnew)],
+                stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+        if ver.returncode != 0:
+            msg="Error: belenios-tool election verify failed on newly downloaded data from election {}, with output {}\n".format(uuid, ver.stdout).encode()
+            return Status(True, msg)
+        else:
+            logme("Successfully verified new data of {}".format(uuid))
 
     archive_filename = os.path.join(p, "election.bel")
 
     # if not the first time, run belenios-tool election verify-diff
     msg = b""
     new_ballots = b""
-    fresh = os.path.exists(os.path.join(p, "fresh"))
     if fresh:
         os.remove(os.path.join(p, "fresh"))
     else:
@@ -211,10 +477,23 @@ def write_and_verify_new_data(wdir, uuid, data):
         return Status(True, msg)
     data["checksums"] = checksums.stdout
 
-    # move new files to main subdirectory
+    # move new files to main subdirectory (the raw ballots only if
+    # they changed)
     for f in audit_files + optional_audit_files:
         if data[f] != b'':
-            os.rename(os.path.join(pnew, f), os.path.join(p, f))
+            if f == 'ballots' and same_contents(os.path.join(p, f), data[f]):
+                os.remove(os.path.join(pnew, f))
+                data['ballots_unchanged'] = True
+            else:
+                os.rename(os.path.join(pnew, f), os.path.join(p, f))
+
+    # write canonical forms of the ballots
+    data['ballots.txt'] = canonical_ballots(data['ballots'])
+    data['ballot_summary.txt'] = canonical_ballot_summary(ballot_summary2)
+    for f in canonical_ballot_files:
+        if not same_contents(os.path.join(p, f), data[f]):
+            with open(os.path.join(p, f), "wb") as file:
+                file.write(data[f])
 
     # extract new archive
     with tarfile.open(archive_filename) as bel:
@@ -227,9 +506,13 @@ def write_and_verify_new_data(wdir, uuid, data):
             msg = "Error: election.json of election {} differs from its archive".format(uuid).encode()
             return Status(True, msg)
         os.remove(os.path.join(p, "election.json"))
-        for m in members:
-            bel.extract(m, path=p)
+        if blobcache:
+            blobcache_extract(wdir, p, bel, members)
+        else:
+            for m in members:
+                bel.extract(m, path=p)
     os.remove(archive_filename)
+    write_bel_head(p, bel_head)
 
     return Status(False, msg)
 
@@ -274,33 +557,75 @@ def check_audit_cache(data):
     return Status(fail, msg)
 
 
-def commit_file(eldir, f, uuid):
-    gitadd = subprocess.run(["git", "-C", eldir, "add", f])
-    if gitadd.returncode != 0:
-        Elogme("Failed git add {} for election {}".format(f, uuid))
-        return False
-    return True
+# Files of an election to be added to its git repository
+def commit_paths(data):
+    paths = [f for f in audit_files + optional_audit_files + canonical_ballot_files
+             if not f.startswith("election.") and not (f == 'ballots' and data.get('ballots_unchanged')) and f in data.keys() and data[f] != b'']
+    return paths + data.get("members", [])
 
-def commit(wdir, uuid, msg):
+# Add paths and commit. If durable is False, git does not fsync, and
+# the caller is responsible for syncing later.
+def commit(wdir, uuid, paths, msg, durable=True):
     eldir = os.path.join(wdir, uuid)
-    for f in audit_files + optional_audit_files:
-        if not f.startswith("election.") and f in data.keys() and data[f] != b'':
-            if not commit_file(eldir, f, uuid):
-                return False
-    for f in data["members"]:
-        if not commit_file(eldir, f, uuid):
+    git = ["git", "-C", eldir]
+    if not durable:
+        git = git + ["-c", "core.fsync=none"]
+    if paths:
+        # paths are given on stdin: there are two per ballot, which
+        # would exceed the command line length limit
+        gitadd = subprocess.run(git + ["add", "--pathspec-from-file=-", "--pathspec-file-nul"],
+                input="\0".join(paths).encode())
+        if gitadd.returncode != 0:
+            Elogme("Failed git add for election {}".format(uuid))
             return False
 
-    gitci = subprocess.run(["git",
-        "-C", eldir,
+    gitci = subprocess.run(git + [
         "commit", "-q", "--allow-empty", "--allow-empty-message",
         "-m",  msg.decode()])
     if gitci.returncode != 0:
-        Elogme("Failed git commit {} for election {}".format(f, uuid))
+        Elogme("Failed git commit for election {}".format(uuid))
         return False
     logme("Successfully added a commit for {}".format(uuid))
     return True
 
+# Commits run in a dedicated thread, fed through a bounded queue, so
+# that the next election can be downloaded and verified meanwhile.
+# Whatever is in the queue when the thread wakes up is committed as a
+# batch, followed by a single sync.
+class Committer(threading.Thread):
+    def __init__(self, wdir, size):
+        super().__init__()
+        self.wdir = wdir
+        self.queue = queue.Queue(maxsize=size)
+
+    def submit(self, uuid, paths, msg):
+        self.queue.put((uuid, paths, msg))
+
+    # Flush the queue durably and stop the thread
+    def close(self):
+        self.queue.put(None)
+        self.join()
+
+    def run(self):
+        done = False
+        while not done:
+            batch = [self.queue.get()]
+            while True:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            for item in batch:
+                if item is None:
+                    done = True
+                    continue
+                uuid, paths, msg = item
+                try:
+                    commit(self.wdir, uuid, paths, msg, durable=False)
+                except Exception as e:
+                    Elogme("Failed commit for election {}: {}".format(uuid, e))
+            os.sync()
+
 ## When a new ballot arrives, check that it was not seen earlier.
 ## This could be some kind of replay attack (possible only if the voter
 ## revotes).
@@ -322,6 +647,259 @@ def check_noreplay(uuid, path_to_all_ballot_hashs, new_hashs):
     return Status(fail, msg)
 
 
+##################################
+## Index of ballot hashs of all the elections of a wdir, to detect
+## replays across elections
+
+# The index lives in wdir/.ballot_index and is made of fixed-size
+# records (32-byte ballot hash, uuid padded to 32 bytes):
+#  - table: sorted records, searched by bisection;
+#  - bloom: a Bloom filter of the hashs of table, so that most lookups
+#    do not touch table;
+#  - journal: records not yet merged into table, loaded in memory.
+# The new ballots of each election are checked and appended to the
+# journal at once, under an exclusive lock, after catching up with what
+# other monitors sharing the wdir have written. They are thus not lost
+# if a later election fails. The journal is merged into table once it
+# holds BALLOT_INDEX_BATCH records. When the index is created, it is
+# seeded with the all_ballot_hashs files of the elections of the wdir.
+BALLOT_INDEX_DIR = ".ballot_index"
+BALLOT_INDEX_BATCH = 100000
+BALLOT_INDEX_RECORD = 64
+BLOOM_BITS_PER_ENTRY = 10
+BLOOM_MIN_BITS = 8 * 1024 * 1024
+BLOOM_HASHES = 7
+
+def bloom_positions(digest, nbits):
+    return [int.from_bytes(digest[4*i:4*i+4], "big") % nbits for i in range(BLOOM_HASHES)]
+
+def ballot_index_record(digest, uuid):
+    u = uuid.encode()
+    if len(u) > BALLOT_INDEX_RECORD - 32:
+        raise ValueError("uuid {} is too long".format(uuid))
+    return digest + u.ljust(BALLOT_INDEX_RECORD - 32, b"\0")
+
+def ballot_index_uuid(record):
+    return record[32:].rstrip(b"\0").decode()
+
+class BallotIndex:
+    def __init__(self, wdir):
+        self.dir = os.path.join(wdir, BALLOT_INDEX_DIR)
+        os.makedirs(self.dir, exist_ok=True)
+        self.lock = open(os.path.join(self.dir, "lock"), "a")
+        self.table_path = os.path.join(self.dir, "table")
+        self.bloom_path = os.path.join(self.dir, "bloom")
+        self.journal_path = os.path.join(self.dir, "journal")
+        self.table = None
+        self.table_ino = None
+        self.table_len = 0
+        self.bloom = b""
+        self.journal = {}
+        self.journal_ino = None
+        self.journal_pos = 0
+        fcntl.flock(self.lock, fcntl.LOCK_EX)
+        try:
+            if not os.path.exists(os.path.join(self.dir, "seeded")):
+                self.seed(wdir)
+        finally:
+            fcntl.flock(self.lock, fcntl.LOCK_UN)
+
+    # When the index is created, import the ballots already known in
+    # each election of the wdir. Must be called with the lock held.
+    def seed(self, wdir):
+        logme("Seeding the ballot index from the elections of {}".format(wdir))
+        fd = os.open(self.journal_path, os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o644)
+        with os.fdopen(fd, "wb") as f:
+            for uuid in os.listdir(wdir):
+                p = os.path.join(wdir, uuid, 'all_ballot_hashs')
+                if uuid.startswith(".") or not os.path.isfile(p):
+                    continue
+                with open(p, "r") as file:
+                    records = [ballot_index_record(base64.b64decode(h + "="), uuid)
+                               for h in file.read().splitlines() if h]
+                f.write(b"".join(records))
+            f.flush()
+            os.fsync(f.fileno())
+        self.load()
+        for h, uuids in self.merge():
+            Elogme("Error: The ballot {} was seen in elections {}!".format(
+                base64.b64encode(h).decode().strip("="), ", ".join(sorted(uuids))))
+        open(os.path.join(self.dir, "seeded"), "w").close()
+
+    # Must be called with the lock held.
+    def load(self):
+        if self.table is not None:
+            self.table.close()
+        try:
+            self.table = open(self.table_path, "rb")
+            st = os.fstat(self.table.fileno())
+            self.table_ino = st.st_ino
+            self.table_len = st.st_size // BALLOT_INDEX_RECORD
+            with open(self.bloom_path, "rb") as f:
+                self.bloom = f.read()
+        except FileNotFoundError:
+            self.table = None
+            self.table_ino = None
+            self.table_len = 0
+            self.bloom = b""
+        self.journal = {}
+        self.journal_ino = None
+        self.journal_pos = 0
+        self.read_journal()
+
+    # Load the journal records appended since the last call.
+    def read_journal(self):
+        try:
+            with open(self.journal_path, "rb") as f:
+                self.journal_ino = os.fstat(f.fileno()).st_ino
+                f.seek(self.journal_pos)
+                journal = f.read()
+        except FileNotFoundError:
+            return
+        # ignore a partially written last record
+        n = len(journal) // BALLOT_INDEX_RECORD * BALLOT_INDEX_RECORD
+        for i in range(0, n, BALLOT_INDEX_RECORD):
+            r = journal[i:i+BALLOT_INDEX_RECORD]
+            self.journal.setdefault(r[:32], set()).add(ballot_index_uuid(r))
+        self.journal_pos += n
+
+    # Catch up with the changes made by other monitors sharing the wdir.
+    # Must be called with the lock held.
+    def refresh(self):
+        try:
+            table_ino = os.stat(self.table_path).st_ino
+        except FileNotFoundError:
+            table_ino = None
+        try:
+            st = os.stat(self.journal_path)
+            journal_ino, journal_size = st.st_ino, st.st_size
+        except FileNotFoundError:
+            journal_ino, journal_size = None, 0
+        if table_ino != self.table_ino or journal_size < self.journal_pos \
+           or (self.journal_ino is not None and journal_ino != self.journal_ino):
+            # table and journal were replaced by a merge
+            self.load()
+        else:
+            self.read_journal()
+
+    def read_record(self, i):
+        self.table.seek(i * BALLOT_INDEX_RECORD)
+        return self.table.read(BALLOT_INDEX_RECORD)
+
+    # Set of uuids of the elections where the ballot hash was seen.
+    def lookup(self, digest):
+        result = set(self.journal.get(digest, set()))
+        if self.table_len == 0:
+            return result
+        nbits = len(self.bloom) * 8
+        for b in bloom_positions(digest, nbits):
+            if not self.bloom[b // 8] & (1 << (b % 8)):
+                return result
+        lo, hi = 0, self.table_len
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self.read_record(mid)[:32] < digest:
+                lo = mid + 1
+            else:
+                hi = mid
+        while lo < self.table_len:
+            r = self.read_record(lo)
+            if r[:32] != digest:
+                break
+            result.add(ballot_index_uuid(r))
+            lo += 1
+        return result
+
+    # Append records to the journal, and merge it into the table if it
+    # is big enough. Must be called with the lock held.
+    def append(self, records):
+        fd = os.open(self.journal_path, os.O_WRONLY | os.O_CREAT, 0o644)
+        with os.fdopen(fd, "wb") as f:
+            # drop a partially written last record
+            size = os.fstat(fd).st_size // BALLOT_INDEX_RECORD * BALLOT_INDEX_RECORD
+            f.truncate(size)
+            f.seek(size)
+            f.write(b"".join(records))
+            f.flush()
+            os.fsync(f.fileno())
+            journal_len = f.tell() // BALLOT_INDEX_RECORD
+        if journal_len >= BALLOT_INDEX_BATCH:
+            self.merge()
+        else:
+            self.read_journal()
+
+    # Check that the new ballots of an election were not seen in
+    # another election, and add them to the index. Both are done under
+    # an exclusive lock, so that monitors sharing the wdir see each
+    # other's ballots.
+    def check_and_add(self, uuid, new_hashs):
+        fail = False
+        msg = b""
+        fcntl.flock(self.lock, fcntl.LOCK_EX)
+        try:
+            self.refresh()
+            records = []
+            for h in new_hashs.decode().splitlines():
+                digest = base64.b64decode(h + "=")
+                others = self.lookup(digest) - {uuid}
+                if others:
+                    fail = True
+                    msg = msg + "Error: The new ballot {} of election {} was already seen in election(s) {}!\n".format(h, uuid, ", ".join(sorted(others))).encode()
+                records.append(ballot_index_record(digest, uuid))
+            if records:
+                self.append(records)
+        finally:
+            fcntl.flock(self.lock, fcntl.LOCK_UN)
+        if not fail:
+            logme("Successfully checked for a cross-election ballot replay of {}".format(uuid))
+        return Status(fail, msg)
+
+    # Returns the hashs found in several elections, with their uuids.
+    # Must be called with the lock held.
+    def merge(self):
+        with open(self.journal_path, "rb") as f:
+            journal = f.read()
+        journal = sorted(journal[i:i+BALLOT_INDEX_RECORD]
+                         for i in range(0, len(journal) - BALLOT_INDEX_RECORD + 1, BALLOT_INDEX_RECORD))
+        def table_records():
+            if self.table is None:
+                return
+            self.table.seek(0)
+            while True:
+                r = self.table.read(BALLOT_INDEX_RECORD)
+                if len(r) < BALLOT_INDEX_RECORD:
+                    return
+                yield r
+        total = self.table_len + len(journal)
+        nbits = max(BLOOM_MIN_BITS, total * BLOOM_BITS_PER_ENTRY)
+        nbits = (nbits + 7) // 8 * 8
+        bloom = bytearray(nbits // 8)
+        collisions = {}
+        prev = None
+        tmp = self.table_path + ".tmp"
+        with open(tmp, "wb") as f:
+            for r in heapq.merge(table_records(), journal):
+                if r == prev:
+                    continue
+                if prev is not None and r[:32] == prev[:32]:
+                    collisions.setdefault(r[:32], {ballot_index_uuid(prev)}).add(ballot_index_uuid(r))
+                prev = r
+                for b in bloom_positions(r[:32], nbits):
+                    bloom[b // 8] |= 1 << (b % 8)
+                f.write(r)
+            f.flush()
+            os.fsync(f.fileno())
+        with open(self.bloom_path + ".tmp", "wb") as f:
+            f.write(bloom)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(self.bloom_path + ".tmp", self.bloom_path)
+        os.replace(tmp, self.table_path)
+        os.remove(self.journal_path)
+        logme("Merged {} records into the ballot index".format(len(journal)))
+        self.load()
+        return collisions.items()
+
 ##################################
 ## Helper functions for monitoring static files
 
@@ -382,7 +960,20 @@ parser.add_argument("--url", required=True, help="prefix url (without trailing /
 group = parser.add_mutually_exclusive_group()
 group.add_argument("--uuidfile", help="file containing uuid's of election to monitor")
 group.add_argument("--uuid", help="uuid of an election to monitor")
+group.add_argument("--jsonfile", help="file produced by list_live_elections.py --json; elections are monitored in its order")
 parser.add_argument("--wdir", help="work dir where logs are kept")
+parser.add_argument("--ballot-index", type=str2bool, nargs='?',
+                        const=True, default=False, metavar="yes|no",
+                        help="check for ballot replays across all the elections of wdir")
+parser.add_argument("--commit-queue", type=int, default=0, metavar="N",
+                        help="commit in a background thread, with up to N elections waiting (default: 0, commit synchronously)")
+parser.add_argument("--time-budget", type=int, metavar="SECONDS",
+                        help="do not start monitoring new elections after this time")
+parser.add_argument("--blobcache", type=str2bool, nargs='?',
+                        const=True, default=False, metavar="yes|no",
+                        help="share archive members between elections through a content-addressed cache in wdir")
+parser.add_argument("--blobcache-size", type=int, default=1024, metavar="MiB",
+                        help="size budget of the blob cache (default: 1024)")
 # arguments if one wants to monitor the files served by the server:
 parser.add_argument("--checkhash", type=str2bool, nargs='?',
                         const=True, default=True, metavar="yes|no",
@@ -431,6 +1022,11 @@ elif args.uuidfile:
     with open(args.uuidfile, "r") as file:
         for line in file:
             uuids.append(line.rstrip())
+elif args.jsonfile:
+    with open(args.jsonfile, "r") as file:
+        for line in file:
+            if line.strip():
+                uuids.append(json.loads(line)["uuid"])
 
 # check that wdir exists and is r/w (if uuids given)
 if uuids:
@@ -522,56 +1118,86 @@ if args.checkhash == True:
 ########### Monitor elections
 
 if uuids:
-    logme("[{}] Starting monitoring elections.".format(datetime.datetime.now()))
-
-for uuid in uuids:
-    logme("Start monitoring election {}".format(uuid))
-
-    check_or_create_dir(args.wdir, uuid)
-
-    status, data = download_audit_data(args.wdir, args.url.strip("/"), uuid)
-
-    # if we managed to download stuff, then check what we can
-    if not status.fail:
-        stat = write_and_verify_new_data(args.wdir, uuid, data)
-        status.merge(stat)
-
-        stat = check_hash_ballots(data)
-        status.merge(stat)
-
-        stat = check_audit_cache(data)
-        status.merge(stat)
-        # create the hash_voterlist file, with the value read from index.html
-        # or check that its value is consistent
-        p = os.path.join(args.wdir, uuid, 'hash_voterlist')
-        if os.path.exists(p):
-            with open(p, "rb") as file:
-                oldhash = file.read()
-            if (oldhash != data['hash_voterlist']):
-                status.merge(Status(True,
-                    "Error: hash of the voter list changed for election {}".format(uuid).encode()))
-        else:
-            with open(p, "wb") as file:
-                file.write(data['hash_voterlist'])
-
-        # create the all_ballot_hashs file, or update it from the new
-        # ballot files. Check that an old ballot was not replayed.
-        # Note: the list of new ballot hashs is created earlier, during
-        # write_and_verify_new_data(), because it must compare the old
-        # and new ballot box.
-        p = os.path.join(args.wdir, uuid, 'all_ballot_hashs')
-        if os.path.exists(p):
-            stat = check_noreplay(uuid, p, data['new_ballots'])
+    start = datetime.datetime.now()
+    logme("[{}] Starting monitoring elections.".format(start))
+    if args.blobcache:
+        init_blobcache(args.wdir)
+    if args.ballot_index:
+        ballot_index = BallotIndex(args.wdir)
+    if args.commit_queue > 0:
+        committer = Committer(args.wdir, args.commit_queue)
+        committer.start()
+
+# The committer must be flushed and stopped even if monitoring fails,
+# otherwise its thread keeps the process alive.
+try:
+    for i, uuid in enumerate(uuids):
+        if args.time_budget is not None and datetime.datetime.now() - start > datetime.timedelta(seconds=args.time_budget):
+            Elogme("Time budget exhausted, {} elections not monitored".format(len(uuids) - i))
+            break
+        logme("Start monitoring election {}".format(uuid))
+
+        check_or_create_dir(args.wdir, uuid)
+        if args.blobcache:
+            set_git_alternates(args.wdir, uuid)
+
+        status, data = download_audit_data(args.wdir, args.url.strip("/"), uuid)
+
+        # if we managed to download stuff, then check what we can
+        if not status.fail:
+            stat = write_and_verify_new_data(args.wdir, uuid, data, args.blobcache)
+            status.merge(stat)
+
+            stat = check_hash_ballots(data)
+            status.merge(stat)
+
+            stat = check_audit_cache(data)
             status.merge(stat)
+            # create the hash_voterlist file, with the value read from index.html
+            # or check that its value is consistent
+            p = os.path.join(args.wdir, uuid, 'hash_voterlist')
+            if os.path.exists(p):
+                with open(p, "rb") as file:
+                    oldhash = file.read()
+                if (oldhash != data['hash_voterlist']):
+                    status.merge(Status(True,
+                        "Error: hash of the voter list changed for election {}".format(uuid).encode()))
+            else:
+                with open(p, "wb") as file:
+                    file.write(data['hash_voterlist'])
+
+            # create the all_ballot_hashs file, or update it from the new
+            # ballot files. Check that an old ballot was not replayed.
+            # Note: the list of new ballot hashs is created earlier, during
+            # write_and_verify_new_data(), because it must compare the old
+            # and new ballot box.
+            p = os.path.join(args.wdir, uuid, 'all_ballot_hashs')
+            if os.path.exists(p):
+                stat = check_noreplay(uuid, p, data['new_ballots'])
+                status.merge(stat)
+            else:
+                with open(p, "wb") as file:
+                    file.write(data['new_ballots'])
+
+            # Check that no new ballot was seen in another election
+            if args.ballot_index:
+                stat = ballot_index.check_and_add(uuid, data.get('new_ballots', b''))
+                status.merge(stat)
+
+        # commit
+        if status.msg != b'':
+            Elogme("Commit log for election {} is {}".format(uuid,
+                status.msg.decode()))
+        if args.commit_queue > 0:
+            committer.submit(uuid, commit_paths(data), status.msg)
         else:
-            with open(p, "wb") as file:
-                file.write(data['new_ballots'])
-
-    # commit
-    if status.msg != b'':
-        Elogme("Commit log for election {} is {}".format(uuid,
-            status.msg.decode()))
-    commit(args.wdir, uuid, status.msg)
+            commit(args.wdir, uuid, commit_paths(data), status.msg)
+finally:
+    if uuids and args.commit_queue > 0:
+        committer.close()
+
+if uuids and args.blobcache:
+    blobcache_evict(args.wdir, args.blobcache_size * 1024 * 1024)
 
 if args.logfile:
     log_file.close()